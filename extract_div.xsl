@@ -1,36 +1,38 @@
 <xsl:stylesheet version="3.0"
     xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:xs="http://www.w3.org/2001/XMLSchema"
     xmlns:tei="http://www.tei-c.org/ns/1.0"
     exclude-result-prefixes="#all">
 
   <!-- Identity -->
   <xsl:mode on-no-match="shallow-copy"/>
 
-  <!-- Parameter -->
-  <xsl:param name="div-id"/>
+  <!-- Parameter: whitespace-separated list of div xml:ids to extract -->
+  <xsl:param name="div-ids" as="xs:string" select="''"/>
+  <xsl:variable name="ids" select="tokenize($div-ids, '\s+')[.]" as="xs:string*"/>
 
-  <!-- Root template -->
+  <!-- Root template: one result document per requested div, so the source
+       tree is traversed once for the whole batch -->
   <xsl:template match="/">
-    <TEI xmlns="http://www.tei-c.org/ns/1.0">
-      <xsl:copy-of select="//tei:teiHeader"/>
-
-      <text>
-        <body>
-
-          <!-- Copy nearest preceding pb -->
-          <xsl:copy-of
-            select="//tei:div[@xml:id=$div-id]
-                      /preceding::tei:pb[1]"
-          />
-
-          <!-- Copy the div itself -->
-          <xsl:copy-of
-            select="//tei:div[@xml:id=$div-id]"
-          />
-
-        </body>
-      </text>
-    </TEI>
+    <xsl:for-each select="//tei:div[@xml:id = $ids]">
+      <xsl:result-document href="{@xml:id}.xml">
+        <TEI xmlns="http://www.tei-c.org/ns/1.0">
+          <xsl:copy-of select="//tei:teiHeader"/>
+
+          <text>
+            <body>
+
+              <!-- Copy nearest preceding pb -->
+              <xsl:copy-of select="preceding::tei:pb[1]"/>
+
+              <!-- Copy the div itself -->
+              <xsl:copy-of select="."/>
+
+            </body>
+          </text>
+        </TEI>
+      </xsl:result-document>
+    </xsl:for-each>
   </xsl:template>
 
 </xsl:stylesheet>
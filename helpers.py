@@ -1,86 +1,125 @@
+import io # Provides in-memory byte streams
 import os # Provides functions for interacting with the operating system
+import hashlib # Content hashing for the transform result cache
 import re # Provides support for regular expressions
 import csv # Provides functions to work with CSV files
-import xml.etree.ElementTree as ET # XML parsing library
+from lxml import etree as ET # XML parsing library (C implementation of the ElementTree API)
 from jinja2 import Environment, FileSystemLoader, select_autoescape # Jinja2 templating engine for HTML generation
+from markupsafe import escape # Same HTML escaping Jinja2's autoescape applies
 from saxonche import PySaxonProcessor # Library for running XSLT and XPath with Saxon-EE
 
 TEI_NS = "http://www.tei-c.org/ns/1.0" # Defines the TEI XML namespace
 
+# Namespace-qualified names, bound once so tight loops compare interned strings
+XML_ID = "{http://www.w3.org/XML/1998/namespace}id" # The xml:id attribute
+DIV_TAG = f"{{{TEI_NS}}}div" # Text division
+PB_TAG = f"{{{TEI_NS}}}pb" # Page break
+CB_TAG = f"{{{TEI_NS}}}cb" # Column break
+MS_TAG = f"{{{TEI_NS}}}milestone" # Milestone (column breaks carry unit="column")
+L_TAG = f"{{{TEI_NS}}}l" # Verse line
+LG_TAG = f"{{{TEI_NS}}}lg" # Line group
+P_TAG = f"{{{TEI_NS}}}p" # Paragraph
+SP_TAG = f"{{{TEI_NS}}}sp" # Speech
+
+# Precompiled regexes used in per-line loops
+_WS_RE = re.compile(r"\s+") # Runs of whitespace
+_EM_RE = re.compile(r"</?em>") # HTML emphasis tags
+
+# Shared Jinja2 environment and template cache; templates never change mid-run,
+# so each one is compiled at most once per process
+_JINJA_ENV = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates")),
+    autoescape=select_autoescape(['html']),
+    auto_reload=False,
+    cache_size=-1
+)
+_TMPL_CACHE = {}
+
+# Shared Saxon processor and precompiled cleaning stylesheets, created once at import
+# so the per-div transforms skip processor startup and stylesheet compilation
+_PROC = PySaxonProcessor(license=False)
+_XSLT = _PROC.new_xslt30_processor()
+_EXEC = {
+    edition: _XSLT.compile_stylesheet(stylesheet_file=os.path.join(os.getcwd(), f"cleaning_{edition}.xsl"))
+    for edition in ("diplomatic", "critical")
+}
+
+# Memoized transform results keyed by (edition, digest of the source TEI). Valid
+# because the cleaning stylesheets are pure functions of their input; lets divs
+# with identical content reuse one transform per edition
+_TRANSFORM_CACHE = {}
+
 # --- XSLT Transformation Function ---
 
-def transform_div_with_xslt(tei_path, edition='diplomatic', xslt_path=None):
+def transform_div_with_xslt(source_node, edition='diplomatic', xslt_path=None):
     """
-    Run Saxon XSLT to transform the TEI XML into a cleaned version (diplomatic or critical).
-    Returns the transformed XML as a string.
+    Run Saxon XSLT to transform the TEI XML (an already-parsed XdmNode) into a cleaned
+    version (diplomatic or critical). Returns the transformed XML as a string.
     """
-    # Determine the XSLT stylesheet file to use
+    # Use a precompiled executable for the standard editions; compile ad hoc otherwise
     if xslt_path is None:
-        xslt_filename = f"cleaning_{edition}.xsl"
+        executable = _EXEC[edition]
     else:
-        xslt_filename = xslt_path
-    
-    # Resolve the full path to the stylesheet
-    base_dir = os.getcwd()
-    xslt_path = os.path.join(base_dir, xslt_filename)
-    
-    # Initialize the Saxon processor
-    with PySaxonProcessor(license=False) as proc:
-        xslt_proc = proc.new_xslt30_processor()
-        
-        # Execute the transformation
-        try:
-            result = xslt_proc.transform_to_string(
-                source_file=tei_path,
-                stylesheet_file=xslt_path
-            )
-        except Exception as e:
-            print(f"Error during XSLT transformation: {e}")
-            return None
-
-        return result
+        executable = _XSLT.compile_stylesheet(stylesheet_file=os.path.join(os.getcwd(), xslt_path))
+
+    # Execute the transformation
+    try:
+        return executable.transform_to_string(xdm_node=source_node)
+    except Exception as e:
+        print(f"Error during XSLT transformation: {e}")
+        return None
     
 # --- Text Extraction and Markup Application ---
 
+# Opening/closing delimiters applied around the content of editorial tags
+_MARKUP_DELIMS = {
+    "ex": ("<em>", "</em>"), # Expansion
+    "add": ("[", "]"), # Addition
+    "supplied": ("[", "]"), # Supplied
+    "del": ("(", ")"), # Deletion
+    "surplus": ("(", ")"), # Surplus
+}
+
 def get_text_with_markup(node):
     """
-    Recursively extracts text from an XML node and applies custom, TEI-inspired markup
-    to represent editorial tags like <ex>, <add>, <supplied>, <del>, <surplus>, and <gap>.
+    Extracts text from an XML node and applies custom, TEI-inspired markup to represent
+    editorial tags like <ex>, <add>, <supplied>, <del>, <surplus>, and <gap>.
+    Walks the subtree iteratively with an explicit stack to avoid per-node call frames
+    and recursion-depth limits on deeply nested markup.
     """
     text_parts = []
-    # Helper to get the local tag name without the namespace URI
-    ns_tag = lambda t: t.rsplit('}', 1)[-1] if '}' in t else t
-
-    tag = ns_tag(node.tag)
-
-    # Apply specific markup based on the tag
-    if tag == "ex": # Expansion
-        inner = "".join(get_text_with_markup(c) for c in node)
-        text_parts.append(f"<em>{(node.text or '')}{inner}</em>")
-        if node.tail:
-            text_parts.append(node.tail)
-    elif tag in {"add", "supplied"}: # Addition or Supplied
-        inner = "".join(get_text_with_markup(c) for c in node)
-        text_parts.append(f"[{(node.text or '')}{inner}]")
-        if node.tail:
-            text_parts.append(node.tail)
-    elif tag in {"del", "surplus"}: # Deletion or Surplus
-        inner = "".join(get_text_with_markup(c) for c in node)
-        text_parts.append(f"({(node.text or '')}{inner})")
-        if node.tail:
-            text_parts.append(node.tail)
-    elif tag == "gap": # Gap in the text
-        inner = "".join(get_text_with_markup(c) for c in node)
-        text_parts.append(f" [...]")
-        if node.tail:
-            text_parts.append(node.tail)
-    else: # Default behavior: just concatenate text and process children
-        if node.text:
-            text_parts.append(node.text)
-        for c in node:
-            text_parts.append(get_text_with_markup(c))
-        if node.tail:
-            text_parts.append(node.tail)
+    # Stack entries are either ("node", element) awaiting a visit or
+    # ("str", text) emitted verbatim (closing delimiters and tails)
+    stack = [("node", node)]
+    while stack:
+        kind, item = stack.pop()
+        if kind == "str":
+            text_parts.append(item)
+            continue
+
+        # Get the local tag name without the namespace URI
+        tag = item.tag.rsplit('}', 1)[-1] if '}' in item.tag else item.tag
+
+        if tag == "gap": # Gap in the text: replace the content entirely
+            text_parts.append(" [...]")
+            if item.tail:
+                text_parts.append(item.tail)
+            continue
+
+        opening, closing = _MARKUP_DELIMS.get(tag, ("", ""))
+        if opening:
+            text_parts.append(opening)
+        if item.text:
+            text_parts.append(item.text)
+
+        # Push the tail and closing delimiter first, then the children in reverse,
+        # so they pop back off in document order
+        if item.tail:
+            stack.append(("str", item.tail))
+        if closing:
+            stack.append(("str", closing))
+        for c in reversed(list(item)):
+            stack.append(("node", c))
 
     return "".join(text_parts)
 
@@ -92,200 +131,245 @@ def extract_lines_from_xml(xml_str, initial_folio="", initial_col=""):
     and maps contextual metadata (line number, grouping, folio, column, speaker) to it.
     Returns a list of dictionaries, one for each line.
     """
-    import xml.etree.ElementTree as ET
-    ns = {"tei": TEI_NS} # TEI namespace
-    root = ET.fromstring(xml_str)
     lines = []
     line_counter = 0
-    
-    # Limit node list to the main <div> or the whole document
-    div_elem = root.find('.//tei:div', ns)
-    doc_nodes = list(div_elem.iter()) if div_elem is not None else list(root.iter())
-
-    # Build a map of child -> parent for all nodes to traverse up the tree
-    parent_map = {c: p for p in doc_nodes for c in p}
-
     # Tags considered as grouping containers for lines
-    GROUP_TAGS = {"lg", "p", "sp"}
-    ancestor_group_map = {} # Maps unique ancestor elements to a stable group ID
+    GROUP_TAGS = {LG_TAG, P_TAG, SP_TAG}
+    group_ids = {} # Maps grouping elements to a stable group ID, assigned on first line
     next_group_id = 0
-
-    def find_group_for_node(node):
-        # Finds the nearest ancestor element that is a grouping tag (<lg>, <p>, <sp>)
-        cur = node
-        while cur in parent_map:
-            parent = parent_map[cur]
-            tag_local = parent.tag.rsplit('}', 1)[-1] if '}' in parent.tag else parent.tag
-            if tag_local in GROUP_TAGS:
-                return parent
-            cur = parent
-        return None
-
-    # Iterate over every line (<l>) element
-    for l in root.findall(".//tei:l", ns):
-        line_counter += 1
-        
-        # Apply editorial markup to the line's text
-        text = get_text_with_markup(l)
-        # Normalize multiple spaces into single spaces
-        text = re.sub(r"\s+", " ", text).strip()
-
-        # Get the line's XML ID
-        xml_ns = "{http://www.w3.org/XML/1998/namespace}id"
-        l_id = l.get(xml_ns) or l.get("id") or ""
-
-        # Determine the line's group ID
-        ancestor = find_group_for_node(l)
-        if ancestor is not None:
-            if ancestor not in ancestor_group_map:
-                next_group_id += 1
-                ancestor_group_map[ancestor] = next_group_id
-            lg_num = ancestor_group_map[ancestor]
-        else:
-            lg_num = 0
-        lg_id = str(lg_num) if lg_num > 0 else ""
-
-        # Find the preceding <pb> element to determine the folio number
-        folio = initial_folio # Start with the folio from the source TEI
-        try:
-            idx = doc_nodes.index(l)
-            # Scan backward through all preceding nodes for the nearest <pb>
-            for prev in reversed(doc_nodes[:idx]):
-                prev_tag = prev.tag.rsplit('}', 1)[-1] if '}' in prev.tag else prev.tag
-                if prev_tag == 'pb':
-                    folio = prev.get('n') or prev.get(xml_ns) or initial_folio
-                    break
-        except ValueError:
-            folio = initial_folio
-
-        # Find the preceding <cb> or <milestone> element to determine the column
-        col = initial_col # Start with the column from the source TEI
-        try:
-            idx = doc_nodes.index(l)
-            # Scan backward through all preceding nodes for the nearest column break
-            for prev in reversed(doc_nodes[:idx]):
-                prev_tag = prev.tag.rsplit('}', 1)[-1] if '}' in prev.tag else prev.tag
-                if prev_tag == 'cb':
-                    col = prev.get('n') or prev.get(xml_ns) or initial_col
-                    break
-                if prev_tag == 'milestone' and prev.get('unit') == 'column':
-                    col = prev.get('n') or prev.get(xml_ns) or initial_col
-                    break
-        except ValueError:
-            col = initial_col
-
-        # Find the nearest ancestor <sp> element and extract the speaker name
-        speaker = ""
-        try:
-            idx = doc_nodes.index(l)
-            # Scan backward through all preceding nodes for the nearest <sp>
-            for prev in reversed(doc_nodes[:idx]):
-                prev_tag = prev.tag.rsplit('}', 1)[-1] if '}' in prev.tag else prev.tag
-                if prev_tag == 'sp':
-                    # Extract the speaker ID from the 'who' attribute
-                    speaker = prev.attrib.get('who', '')
-                    # Clean up the speaker ID
-                    if speaker.startswith('#'):
-                        speaker = speaker[1:]
-                    break
-        except (ValueError, AttributeError):
-            pass
-
-        # Append the line data to the list
-        lines.append({"line_no": line_counter, "text": text, "lg": lg_id,
-                      "l_id": l_id, "folio": folio, "col": col, "speaker": speaker})
+    group_stack = [] # Currently open grouping elements (nearest ancestor on top)
+
+    # Running state, updated as markers are encountered in document order.
+    # Markers are only honoured inside the main <div>, as before.
+    div_depth = 0 # Nesting depth of <div> elements (state is live while > 0)
+    current_folio = initial_folio # Start with the folio from the source TEI
+    current_col = initial_col # Start with the column from the source TEI
+    current_speaker = "" # Speaker from the most recent <sp>
+    pending = [] # Stack of state snapshots for currently open <l> elements
+
+    # Stream-parse the document; subtrees are released as soon as each line is emitted,
+    # so peak memory is bounded by tree depth rather than document size. The tag tuple
+    # makes lxml filter events in C, so only the structural elements reach this loop.
+    events = ET.iterparse(io.BytesIO(xml_str.encode("utf-8")), events=("start", "end"),
+                          tag=(DIV_TAG, PB_TAG, CB_TAG, MS_TAG, LG_TAG, P_TAG, SP_TAG, L_TAG),
+                          remove_comments=True, remove_pis=True)
+    for event, node in events:
+        tag = node.tag
+
+        if event == "start":
+            if tag == DIV_TAG:
+                div_depth += 1
+            elif div_depth > 0:
+                if tag == PB_TAG: # Page break: update the running folio
+                    current_folio = node.get('n') or node.get(XML_ID) or initial_folio
+                elif tag == CB_TAG: # Column break: update the running column
+                    current_col = node.get('n') or node.get(XML_ID) or initial_col
+                elif tag == MS_TAG and node.get('unit') == 'column':
+                    current_col = node.get('n') or node.get(XML_ID) or initial_col
+                elif tag in GROUP_TAGS:
+                    group_stack.append(node)
+                    if tag == SP_TAG:
+                        # Extract the speaker ID from the 'who' attribute
+                        speaker = node.attrib.get('who', '')
+                        if speaker.startswith('#'):
+                            speaker = speaker[1:]
+                        current_speaker = speaker
+
+            if tag == L_TAG:
+                # Snapshot the state now; markers inside the line apply to later lines only
+                if div_depth > 0:
+                    if group_stack:
+                        ancestor = group_stack[-1]
+                        if ancestor not in group_ids:
+                            next_group_id += 1
+                            group_ids[ancestor] = next_group_id
+                        lg_id = str(group_ids[ancestor])
+                    else:
+                        lg_id = ""
+                    pending.append((current_folio, current_col, current_speaker, lg_id))
+                else:
+                    # Lines outside the div get the initial state and no group
+                    pending.append((initial_folio, initial_col, "", ""))
+            continue
+
+        # --- 'end' events ---
+        if tag == DIV_TAG:
+            div_depth -= 1
+        elif div_depth > 0 and tag in GROUP_TAGS:
+            group_stack.pop()
+        elif tag == L_TAG:
+            line_counter += 1
+            folio, col, speaker, lg_id = pending.pop()
+
+            # Apply editorial markup to the line's text (the subtree is complete
+            # here); whitespace is normalized in one batch after the loop
+            text = get_text_with_markup(node)
+
+            # Get the line's XML ID
+            l_id = node.get(XML_ID) or node.get("id") or ""
+
+            # Append the line data to the list
+            lines.append({"line_no": line_counter, "text": text, "lg": lg_id,
+                          "l_id": l_id, "folio": folio, "col": col, "speaker": speaker})
+
+            # Release the processed subtree and any already-consumed preceding siblings
+            node.clear(keep_tail=True)
+            parent = node.getparent()
+            if parent is not None:
+                while node.getprevious() is not None:
+                    del parent[0]
+
+    # Normalize whitespace across all lines in a single substitution over the
+    # sentinel-joined text instead of one re.sub call per line. NUL cannot occur
+    # in XML text and is not whitespace, so the line boundaries survive the pass
+    # and the per-line strip finishes the job.
+    if lines:
+        normalized = _WS_RE.sub(" ", "\x00".join(entry["text"] for entry in lines))
+        for entry, text in zip(lines, normalized.split("\x00")):
+            entry["text"] = text.strip()
     return lines
 
 # --- Output Writing Functions ---
 
 def write_txt(lines, outpath):
-    # *** Write line data to a plain text file ***
-    os.makedirs(os.path.dirname(outpath), exist_ok=True) # Ensure directory exists
+    # *** Write line data to a plain text file (the caller pre-creates the directory) ***
     with open(outpath, "w", encoding="utf8") as fh:
-        for entry in lines:
-            # Remove HTML emphasis tags (<em>) before writing to TXT
-            text = re.sub(r"</?em>", "", entry["text"])
-            fh.write(text + "\n")
+        if lines:
+            # Remove HTML emphasis tags (<em>) and emit all lines in one write
+            fh.write("\n".join(_EM_RE.sub("", entry["text"]) for entry in lines) + "\n")
 
 def write_csv(lines, outpath):
-    # *** Write line data to a CSV file ***
-    os.makedirs(os.path.dirname(outpath), exist_ok=True) # Ensure directory exists
+    # *** Write line data to a CSV file (the caller pre-creates the directory) ***
     fieldnames = ["line_no", "text", "lg", "l_id", "folio", "col", "speaker"]
-    with open(outpath, "w", newline="", encoding="utf8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in lines:
-            # Remove HTML emphasis tags (<em>) before writing to CSV
-            text = re.sub(r"</?em>", "", row["text"])
-            writer.writerow({**row, "text": text})
+    # csv.writer flushes row by row, so a 1 MiB buffer keeps whole files to one syscall
+    with open(outpath, "w", newline="", encoding="utf8", buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        # Project each row into a tuple in field order (the extractor always sets
+        # every key), removing HTML emphasis tags (<em>) from the text on the way
+        writer.writerows((row["line_no"], _EM_RE.sub("", row["text"]), row["lg"],
+                          row["l_id"], row["folio"], row["col"], row["speaker"])
+                         for row in lines)
+
+def render_lines_html(lines, folio_to_canvas):
+    """
+    Renders the per-line body of a page (folio markers, line groups, speaker
+    labels, and the lines themselves) as a single HTML string. This is the hot
+    loop of page rendering, so it runs as plain Python string building instead
+    of per-iteration Jinja2 dispatch; the markup and escaping mirror what the
+    page template's loop used to produce.
+    """
+    parts = []
+    last_lg = None # data-lg of the currently open group
+    last_folio = None # Folio of the most recent marker
+    current_speaker = None # Speaker label already shown in the open group
+    group_open = False
+
+    for row in lines:
+        folio = str(row["folio"]).strip()
+        lg = str(row["lg"]).strip()
+
+        # 1. Close Group
+        if group_open and (lg != last_lg or folio != last_folio):
+            parts.append("</div>")
+            group_open = False
+
+        # 2. Folio Marker
+        if folio != last_folio:
+            canvas_url = folio_to_canvas.get(folio, '') or ''
+            parts.append('<div class="folio-marker" \n'
+                         f'                 data-canvas-url="{escape(canvas_url)}">\n'
+                         f'              Folio {escape(folio)}\n'
+                         '            </div>')
+            last_folio = folio
+
+        # 3. Open Group
+        if not group_open:
+            parts.append(f'<div class="lg-group" data-lg="{escape(lg)}">')
+            group_open = True
+            last_lg = lg
+            current_speaker = None
+
+        # 4. Speaker
+        speaker = row["speaker"]
+        if speaker and speaker != current_speaker:
+            parts.append(f'<div class="speaker-label">{escape(speaker)}</div>')
+            current_speaker = speaker
+
+        # 5. Line (the text already carries its editorial markup, so it is not escaped)
+        parts.append('\n          <div class="line">\n'
+                     f'            <span class="ln">{escape(row["line_no"])}</span>\n'
+                     f'            <span class="line-text">{row["text"]}</span>\n'
+                     '          </div>')
+
+    if group_open:
+        parts.append("</div>")
+    return "".join(parts)
 
 def render_html(template_name, context, outpath):
-    # *** Render line data into an HTML file using Jinja2 ***
-    os.makedirs(os.path.dirname(outpath), exist_ok=True) # Ensure directory exists
-    tmpl_dir = os.path.join(os.path.dirname(__file__), "templates")
-    env = Environment(loader=FileSystemLoader(tmpl_dir), autoescape=select_autoescape(['html']))
-    tmpl = env.get_template(template_name)
-    html = tmpl.render(**context) # Render the template with the provided data
-    with open(outpath, "w", encoding="utf8") as fh:
-        fh.write(html)
+    # *** Render line data into an HTML file using Jinja2 (the caller pre-creates the directory) ***
+    tmpl = _TMPL_CACHE.setdefault(template_name, _JINJA_ENV.get_template(template_name))
+    # The render stream emits many small chunks; a 1 MiB buffer batches them up
+    with open(outpath, "w", encoding="utf8", buffering=1 << 20) as fh:
+        # Stream rendered chunks straight into the file instead of materializing
+        # the whole document as one string first
+        tmpl.stream(**context).dump(fh)
 
 # --- Main Processing Function ---
 
-def process_div(tei_path, out_root="out", div_id=None, initial_folio="", initial_col="", manifest_url="", metadata_dict=None):
+def process_div(div_id, tei_xml, out_root="out", initial_folio="", initial_col="", manifest_url="", metadata_dict=None, folio_to_canvas=None):
     """
-    Orchestrates the transformation, extraction, and output of TEI XML for a single div.
+    Orchestrates the transformation, extraction, and output of TEI XML for a single div,
+    working entirely from the in-memory TEI string produced by the extraction transform.
+    folio_to_canvas is the document-wide folio -> IIIF canvas mapping built by the caller.
     Generates TXT, CSV, and HTML for both 'diplomatic' and 'critical' editions.
     """
-    # Use provided ID or the filename as the base name
-    if div_id:
-        tei_basename = div_id
-    else:
-        tei_basename = os.path.splitext(os.path.basename(tei_path))[0]
-    
-    # 1. Extract details from the metadata
-    div_state = metadata_dict.get(tei_basename, {}).get('state', 'incomplete').lower()
+    tei_basename = div_id
+
+    # 1. Extract details from the metadata (one lookup per div)
+    md = (metadata_dict or {}).get(tei_basename) or {}
+    div_state = md.get('state', 'incomplete').lower()
     norm_div_state = div_state.replace(' ', '-') # Normalized state for directory names
-    title = metadata_dict.get(tei_basename, {}).get('title', tei_basename)
-    notes = metadata_dict.get(tei_basename, {}).get('notes', '')
+    title = md.get('title', tei_basename)
+    notes = md.get('notes', '')
     
     # Base paths for output types
     out_txt = os.path.join(out_root, "txt")
     out_csv = os.path.join(out_root, "csv")
     out_html = os.path.join(out_root, "html")
 
-    # 2. Create the full state-sorted base directories
+    # 2. Resolve the state-sorted base directories (the driver creates the full
+    # directory tree up front, so nothing here needs os.makedirs)
     state_txt_dir = os.path.join(out_txt, norm_div_state)
     state_csv_dir = os.path.join(out_csv, norm_div_state)
 
-    # 3. Create edition-specific subfolders (e.g., out/txt/complete/diplomatic)
-    for d in [state_txt_dir, state_csv_dir]:
-        os.makedirs(os.path.join(d, "diplomatic"), exist_ok=True)
-        os.makedirs(os.path.join(d, "critical"), exist_ok=True)
-    
-    os.makedirs(out_html, exist_ok=True) # Ensure base HTML folder exists
-
     filename_base = tei_basename.lower()
 
-    # Build folio -> canvas mapping from the TEI file (for IIIF image links)
-    folio_to_canvas = {}
-    try:
-        tei_root = ET.parse(tei_path).getroot()
-        ns = {"tei": TEI_NS}
-        for pb in tei_root.findall(".//tei:pb", ns): # Find all page break elements
-            pb_n = pb.get("n") or pb.get("{http://www.w3.org/XML/1998/namespace}id") or ""
-            pb_facs = pb.get("facs") or "" # IIIF canvas ID
-            if pb_n and pb_facs:
-                folio_to_canvas[pb_n] = pb_facs
-    except Exception:
-        pass
+    # Folio -> canvas mapping (for IIIF image links), built once by the caller
+    if folio_to_canvas is None:
+        folio_to_canvas = {}
 
     # 4. Define the allowed states for HTML generation
     ALLOWED_HTML_STATES = ['complete', 'near-complete']
     generate_html = norm_div_state in ALLOWED_HTML_STATES
 
+    # Parse the TEI once into an XdmNode shared by both edition transforms, and
+    # hash it once for the transform result cache
+    source_node = _PROC.parse_xml(xml_text=tei_xml)
+    tei_digest = hashlib.blake2b(tei_xml.encode("utf-8"), digest_size=16).digest()
+
+    # Writes stay synchronous: spawning threads in a forked worker that has run
+    # SaxonC transforms aborts the process (SaxonC's embedded runtime does not
+    # tolerate new threads after fork), and the process pool already overlaps
+    # I/O across divs
     # Process both diplomatic and critical editions
     for edition in ("diplomatic", "critical"):
-        transformed_xml = transform_div_with_xslt(tei_path, edition=edition) # Run XSLT
+        # Run XSLT, reusing a cached result if this exact TEI was seen before
+        cache_key = (edition, tei_digest)
+        transformed_xml = _TRANSFORM_CACHE.get(cache_key)
+        if transformed_xml is None:
+            transformed_xml = transform_div_with_xslt(source_node, edition=edition)
+            _TRANSFORM_CACHE[cache_key] = transformed_xml
         lines = extract_lines_from_xml(transformed_xml, initial_folio=initial_folio, initial_col=initial_col) # Extract line data
 
         # 5. Build state-sorted paths for TXT and CSV
@@ -321,11 +405,10 @@ def process_div(tei_path, out_root="out", div_id=None, initial_folio="", initial
                 "div_id": tei_basename,
                 "title": title,
                 "edition": edition,
-                "lines": lines,
+                "lines_html": render_lines_html(lines, folio_to_canvas), # Pre-rendered line loop
                 "manifest_url": manifest_url,
                 "canvas_url": canvas_url,
                 "initial_folio": initial_folio or "",
-                "folio_to_canvas": folio_to_canvas,
                 "facs": None,
                 "other_version_url": other_version_url,
                 "other_version_label": other_version_label,
@@ -377,93 +460,52 @@ def load_metadata(meta_file_path):
         
     return metadata
 
-def get_folio_and_col_at_div(div_node_xml, source_root):
-    """
-    Finds the nearest preceding <pb> (page break) and <cb> (column break) or <milestone> 
-    elements before the div in the source document to determine the initial folio and column. 
-    Returns (folio, col) strings.
-    """
-    TEI_NS = "{http://www.tei-c.org/ns/1.0}"
-    XML_ID_NS = "{http://www.w3.org/XML/1998/namespace}id"
-    
-    # Extract xml:id from div_xml
-    m = re.search(r'xml:id\s*=\s*"([^"]+)"', div_node_xml)
-    if not m:
-        return "", ""
-    
-    div_id = m.group(1)
-    
-    # Find the div element in the source XML
-    div_elem_in_source = None
-    for elem in source_root.iter():
-        if elem.tag == f"{TEI_NS}div" and elem.get(XML_ID_NS) == div_id:
-            div_elem_in_source = elem
-            break
-    
-    if div_elem_in_source is None:
-        return "", ""
-    
-    # Get a list of all nodes and find the div's position
-    all_nodes = list(source_root.iter())
-    try:
-        div_idx = all_nodes.index(div_elem_in_source)
-    except ValueError:
-        return "", ""
-    
-    # Scan backwards for the nearest <pb> and column break
-    folio = ""
-    col = ""
-    for prev_node in reversed(all_nodes[:div_idx]):
-        if prev_node.tag == f"{TEI_NS}pb" and not folio:
-            folio = prev_node.get('n') or prev_node.get(XML_ID_NS) or ""
-        if not col:
-            if prev_node.tag == f"{TEI_NS}cb":
-                col = prev_node.get('n') or prev_node.get(XML_ID_NS) or ""
-            elif prev_node.tag == f"{TEI_NS}milestone" and prev_node.get('unit') == 'column':
-                col = prev_node.get('n') or prev_node.get(XML_ID_NS) or ""
-        if folio and col:
-            break
-    
-    return folio, col
-
-
-def get_preceding_pb_element(div_node_xml, source_root):
+def scan_source_document(input_file, target_ids):
     """
-    Finds and returns the nearest preceding <pb> element before the div in the source document.
+    Streams the source TEI once with iterparse and gathers everything the driver
+    needs from it: a div_id -> (initial_folio, initial_col) snapshot of the running
+    page/column context at the start of each target div, and the document-wide
+    folio -> IIIF canvas mapping. Completed <div> subtrees are released as the
+    parse advances, so peak memory stays well below a full tree.
+    Returns (div_contexts, folio_to_canvas).
     """
-    TEI_NS = "{http://www.tei-c.org/ns/1.0}"
-    XML_ID_NS = "{http://www.w3.org/XML/1998/namespace}id"
-    
-    # Extract xml:id from div_xml
-    m = re.search(r'xml:id\s*=\s*"([^"]+)"', div_node_xml)
-    if not m:
-        return None
-    
-    div_id = m.group(1)
-    
-    # Find the div element in the source XML
-    div_elem_in_source = None
-    for elem in source_root.iter():
-        if elem.tag == f"{TEI_NS}div" and elem.get(XML_ID_NS) == div_id:
-            div_elem_in_source = elem
-            break
-    
-    if div_elem_in_source is None:
-        return None
-    
-    # Get a list of all nodes and find the div's position
-    all_nodes = list(source_root.iter())
-    try:
-        div_idx = all_nodes.index(div_elem_in_source)
-    except ValueError:
-        return None
-    
-    # Scan backwards for the nearest <pb>
-    for prev_node in reversed(all_nodes[:div_idx]):
-        if prev_node.tag == f"{TEI_NS}pb":
-            return prev_node
-    
-    return None
+    div_contexts = {}
+    folio_to_canvas = {}
+    cur_folio = "" # Folio from the most recent <pb>
+    cur_col = "" # Column from the most recent <cb> or column <milestone>
+
+    events = ET.iterparse(input_file, events=("start", "end"),
+                          tag=(DIV_TAG, PB_TAG, CB_TAG, MS_TAG),
+                          remove_comments=True, remove_pis=True)
+    for event, node in events:
+        tag = node.tag
+        if event == "start":
+            if tag == PB_TAG: # Page break: update the running folio and canvas map
+                cur_folio = node.get('n') or node.get(XML_ID) or ""
+                facs = node.get('facs') # IIIF canvas ID
+                if cur_folio and facs:
+                    folio_to_canvas[cur_folio] = facs
+            elif tag == CB_TAG: # Column break: update the running column
+                cur_col = node.get('n') or node.get(XML_ID) or ""
+            elif tag == MS_TAG:
+                if node.get('unit') == 'column':
+                    cur_col = node.get('n') or node.get(XML_ID) or ""
+            else: # div: snapshot the context if it is one of the targets
+                div_id = node.get(XML_ID)
+                if div_id in target_ids:
+                    div_contexts[div_id] = (cur_folio, cur_col)
+            continue
+
+        # 'end' events: release each completed div subtree and any already-consumed
+        # preceding siblings
+        if tag == DIV_TAG:
+            node.clear(keep_tail=True)
+            parent = node.getparent()
+            if parent is not None:
+                while node.getprevious() is not None:
+                    del parent[0]
+
+    return div_contexts, folio_to_canvas
 
 def simple_folio_sort_key(fol_range):
     """